@@ -1,10 +1,14 @@
 """Main entry point for the Vantron Remote Media Server."""
 
-import asyncio
 import sys
 
 from loguru import logger
 
+try:
+    from uvloop import run
+except ImportError:  # uvloop doesn't support Windows
+    from asyncio import run
+
 from .server import MediaPlayerServer, get_server_config
 
 # Configure loguru
@@ -34,7 +38,7 @@ async def main() -> None:
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        run(main())
     except KeyboardInterrupt:
         logger.info("Server stopped by user")
     except Exception:
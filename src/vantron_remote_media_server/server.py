@@ -1,20 +1,48 @@
 """WebSocket server implementation for the van's media player."""
 
 import asyncio
-import json
+import contextlib
 import os
+import signal
+from collections.abc import Awaitable, Callable
 from dataclasses import dataclass
 from typing import Any
 
+import msgspec
 import websockets
 from loguru import logger
 from websockets.asyncio.server import ServerConnection
 from websockets.exceptions import ConnectionClosed
+from websockets.frames import OP_TEXT, CloseCode, Frame
+from websockets.protocol import State
+
+json_encoder = msgspec.json.Encoder()
 
 # Environment variable configuration
 DEFAULT_HOST = "0.0.0.0"
 DEFAULT_PORT = 9300
 
+# Outgoing messages a client may fall behind by before it's disconnected
+MAX_QUEUED_MESSAGES = 64
+
+# Window in which state changes are coalesced into a single broadcast (seconds)
+STATE_BROADCAST_DELAY = 0.02
+
+# Methods named handle_* that aren't JSON-RPC method handlers
+NON_RPC_HANDLERS = frozenset({"handle_client", "handle_request"})
+
+# Errors send_error() reports without a request ID, serialized once up front
+STATIC_ERROR_MESSAGES: dict[tuple[int, str], bytes] = {
+    (code, message): json_encoder.encode(
+        {"jsonrpc": "2.0", "error": {"code": code, "message": message}, "id": None}
+    )
+    for code, message in (
+        (-32700, "Parse error"),
+        (-32600, "Invalid request"),
+        (-32603, "Internal error"),
+    )
+}
+
 
 def get_server_config() -> tuple[str, int]:
     """Get server configuration from environment variables."""
@@ -27,7 +55,7 @@ def get_server_config() -> tuple[str, int]:
     return host, port
 
 
-@dataclass
+@dataclass(slots=True)
 class PlayerState:
     """Represents the current state of the van's media player."""
 
@@ -38,6 +66,30 @@ class PlayerState:
     error: str | None = None
 
 
+class RpcRequest(msgspec.Struct):
+    """A JSON-RPC request (or notification, without an ID) from a client."""
+
+    method: str | None = None
+    params: dict[str, Any] = {}
+    id: int | float | str | None = None
+
+
+class Notification(msgspec.Struct, kw_only=True):
+    """A JSON-RPC notification sent to clients."""
+
+    jsonrpc: str = "2.0"
+    method: str
+    params: Any
+
+
+request_decoder = msgspec.json.Decoder(RpcRequest)
+
+
+def text_frame(payload: bytes) -> bytes:
+    """Serialize a server-to-client WebSocket text frame carrying a payload."""
+    return Frame(OP_TEXT, payload).serialize(mask=False)
+
+
 class MediaPlayerServer:
     """WebSocket server that handles JSON-RPC requests for van's media playback."""
 
@@ -45,112 +97,210 @@ class MediaPlayerServer:
         self.host = host
         self.port = port
         self.state = PlayerState()
-        self.connections: set[ServerConnection] = set()
+        # Each client's queue of outgoing frames, drained by its writer task
+        self.connections: dict[ServerConnection, asyncio.Queue[bytes | None]] = {}
+        # Framed stateChanged notification, cleared whenever state changes
+        self._state_cache: bytes | None = None
+        # State as of the last broadcast, for computing stateDelta notifications.
+        # It shares values with self.state, so replace them rather than mutating.
+        self._broadcast_state = self.get_state_dict()
+        # Pending broadcast of coalesced state changes, if any
+        self._state_flush: asyncio.TimerHandle | None = None
+        # Set by SIGINT/SIGTERM to stop the server
+        self._shutdown = asyncio.Event()
+        # JSON-RPC method name -> handler, e.g. "setVolume" -> handle_setVolume
+        self._handlers: dict[str, Callable[[dict[str, Any]], Awaitable[Any]]] = {
+            name.removeprefix("handle_"): getattr(self, name)
+            for name in dir(self)
+            if name.startswith("handle_") and name not in NON_RPC_HANDLERS
+        }
 
     async def start(self) -> None:
-        """Start the WebSocket server."""
-        async with websockets.serve(self.handle_client, self.host, self.port):
+        """Start the WebSocket server and run until SIGINT or SIGTERM."""
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            # Unsupported on Windows, where Ctrl+C raises KeyboardInterrupt instead
+            with contextlib.suppress(NotImplementedError):
+                loop.add_signal_handler(sig, self._shutdown.set)
+
+        async with websockets.serve(
+            self.handle_client,
+            self.host,
+            self.port,
+            # JSON-RPC messages are small; compressing them costs more than it
+            # saves. Writers also rely on this to send pre-serialized frames.
+            compression=None,
+            max_size=2**16,
+            max_queue=32,
+        ):
             logger.info(f"Van media server started on ws://{self.host}:{self.port}")
-            await asyncio.Future()  # run forever
+            await self._shutdown.wait()
+            logger.info("Shutting down, closing client connections")
+            if self._state_flush is not None:
+                self._state_flush.cancel()
+            # Leaving the context closes all connections concurrently (code 1001)
+
+        logger.info("Van media server stopped")
 
     async def _handle_message(
         self, websocket: ServerConnection, message: str | bytes, client_info: str
     ) -> None:
         """Handle a single message from a client."""
         try:
-            request = json.loads(message)
-            logger.debug(f"Received request from {client_info}: {request}")
+            request = request_decoder.decode(message)
+            # Formatted by loguru only if debug logging is enabled
+            logger.debug("Received request from {}: {}", client_info, request)
             response = await self.handle_request(request)
             if response:
-                await websocket.send(json.dumps(response))
-        except json.JSONDecodeError:
+                await websocket.send(json_encoder.encode(response), text=True)
+        except msgspec.ValidationError as e:
+            logger.error(f"Invalid request received from {client_info}: {e}")
+            await self.send_error(websocket, -32600, "Invalid request", client_info)
+        # Invalid UTF-8 inside a string raises UnicodeDecodeError, not DecodeError
+        except (msgspec.DecodeError, UnicodeDecodeError):
             logger.error(f"Invalid JSON received from {client_info}")
-            await self.send_error(websocket, -32700, "Parse error")
+            await self.send_error(websocket, -32700, "Parse error", client_info)
         except Exception:
             logger.exception(f"Error handling message from {client_info}")
-            await self.send_error(websocket, -32603, "Internal error")
+            await self.send_error(websocket, -32603, "Internal error", client_info)
 
     async def handle_client(self, websocket: ServerConnection) -> None:
         """Handle a client connection."""
         client_info = f"{websocket.remote_address[0]}:{websocket.remote_address[1]}"
         logger.info(f"New client connected from {client_info}")
 
+        queue: asyncio.Queue[bytes | None] = asyncio.Queue(MAX_QUEUED_MESSAGES)
+        writer = asyncio.create_task(self._write_messages(websocket, queue))
         try:
-            self.connections.add(websocket)
-            await self.send_state_update(websocket)
+            self.connections[websocket] = queue
+            self.send_state_update(websocket, client_info)
 
-            async for message in websocket:
+            while True:
+                # Leave text frames undecoded; the JSON parser validates UTF-8
+                message = await websocket.recv(decode=False)
                 await self._handle_message(websocket, message, client_info)
 
         except ConnectionClosed:
             logger.info(f"Client disconnected: {client_info}")
         finally:
-            self.connections.remove(websocket)
+            # Already gone if it was dropped for falling behind
+            self.connections.pop(websocket, None)
+            writer.cancel()
 
-    async def handle_request(self, request: dict[str, Any]) -> dict[str, Any] | None:
-        """Handle a JSON-RPC request."""
-        if "method" not in request:
-            return self.create_error_response(
-                request.get("id"), -32600, "Invalid request"
-            )
+    async def _write_messages(
+        self, websocket: ServerConnection, queue: asyncio.Queue[bytes | None]
+    ) -> None:
+        """Write a client's queued frames, closing the connection on None."""
+        try:
+            while (frame := await queue.get()) is not None:
+                # Frames bypass send(), so stop once the closing handshake starts
+                if websocket.protocol.state is not State.OPEN:
+                    return
+                websocket.transport.write(frame)
+                await websocket.drain()
+            await websocket.close(CloseCode.TRY_AGAIN_LATER, "Client too slow")
+        except ConnectionClosed:
+            pass
 
-        method = request["method"]
-        params = request.get("params", {})
-        request_id = request.get("id")
+    def _queue_frame(self, websocket: ServerConnection, frame: bytes) -> None:
+        """Queue a frame for a client, dropping the client if it's fallen behind."""
+        queue = self.connections[websocket]
+        try:
+            queue.put_nowait(frame)
+        except asyncio.QueueFull:
+            self._drop_slow_client(websocket)
+
+    def _drop_slow_client(self, websocket: ServerConnection) -> None:
+        """Stop sending to a client that can't keep up and close its connection."""
+        client_addr = f"{websocket.remote_address[0]}:{websocket.remote_address[1]}"
+        logger.warning(f"Client {client_addr} fell too far behind, disconnecting")
+
+        queue = self.connections.pop(websocket)
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(None)
+
+    async def handle_request(self, request: RpcRequest) -> dict[str, Any] | None:
+        """Handle a JSON-RPC request."""
+        method = request.method
+        request_id = request.id
+        if method is None:
+            return self.create_error_response(request_id, -32600, "Invalid request")
 
         # Only process requests with IDs (notifications don't get responses)
         if request_id is None:
             return None
 
-        handler = getattr(self, f"handle_{method}", None)
-        if not handler:
+        handler = self._handlers.get(method)
+        if handler is None:
             logger.warning(f"Method not found: {method}")
             return self.create_error_response(request_id, -32601, "Method not found")
 
         try:
-            result = await handler(params)
+            result = await handler(request.params)
             return {"jsonrpc": "2.0", "result": result, "id": request_id}
         except Exception as e:
             logger.exception(f"Error handling {method}")
             return self.create_error_response(request_id, -32603, str(e))
 
-    async def broadcast_state(self) -> None:
-        """Broadcast state update to all connected clients."""
-        if not self.connections:
+    def broadcast_state(self) -> None:
+        """Broadcast state changes since the last broadcast to all clients."""
+        state = self.get_state_dict()
+        changes = {
+            key: value
+            for key, value in state.items()
+            if value != self._broadcast_state[key]
+        }
+        self._broadcast_state = state
+        if not changes or not self.connections:
             return
 
-        message = {
-            "jsonrpc": "2.0",
-            "method": "stateChanged",
-            "params": self.get_state_dict(),
-        }
-        websockets.broadcast(self.connections, json.dumps(message))
-        logger.debug(f"State broadcast to {len(self.connections)} clients")
+        # Every client is sent the same frame, serialized once
+        frame = text_frame(
+            json_encoder.encode(Notification(method="stateDelta", params=changes))
+        )
+        slow_clients = []
+        for websocket, queue in self.connections.items():
+            try:
+                queue.put_nowait(frame)
+            except asyncio.QueueFull:
+                slow_clients.append(websocket)
+        for websocket in slow_clients:
+            self._drop_slow_client(websocket)
+
+    def _mark_state_dirty(self) -> None:
+        """Note a state change, scheduling a broadcast if one isn't pending."""
+        self._state_cache = None
+        if self._state_flush is None:
+            self._state_flush = asyncio.get_running_loop().call_later(
+                STATE_BROADCAST_DELAY, self._flush_state
+            )
 
-    async def send_state_update(self, websocket: ServerConnection) -> None:
+    def _flush_state(self) -> None:
+        """Broadcast the state changes coalesced since the last broadcast."""
+        self._state_flush = None
+        self.broadcast_state()
+
+    def send_state_update(self, websocket: ServerConnection, client_info: str) -> None:
         """Send current state to a specific client."""
-        message = {
-            "jsonrpc": "2.0",
-            "method": "stateChanged",
-            "params": self.get_state_dict(),
-        }
-        await websocket.send(json.dumps(message))
-        logger.debug(
-            f"State sent to {websocket.remote_address[0]}:{websocket.remote_address[1]}"
-        )
+        self._queue_frame(websocket, self._state_frame())
+        logger.debug("State sent to {}", client_info)
 
     async def send_error(
-        self, websocket: ServerConnection, code: int, message: str
+        self, websocket: ServerConnection, code: int, message: str, client_info: str
     ) -> None:
         """Send an error message to a client."""
-        error_msg = {
-            "jsonrpc": "2.0",
-            "error": {"code": code, "message": message},
-            "id": None,
-        }
-        await websocket.send(json.dumps(error_msg))
-        client_addr = f"{websocket.remote_address[0]}:{websocket.remote_address[1]}"
-        logger.debug(f"Error sent to {client_addr}: {message}")
+        error_msg = STATIC_ERROR_MESSAGES.get((code, message))
+        if error_msg is None:
+            error_msg = json_encoder.encode(
+                {
+                    "jsonrpc": "2.0",
+                    "error": {"code": code, "message": message},
+                    "id": None,
+                }
+            )
+        await websocket.send(error_msg, text=True)
+        logger.debug("Error sent to {}: {}", client_info, message)
 
     def create_error_response(
         self, request_id: Any, code: int, message: str
@@ -162,6 +312,16 @@ class MediaPlayerServer:
             "id": request_id,
         }
 
+    def _state_frame(self) -> bytes:
+        """Get the framed stateChanged notification for the current state."""
+        if self._state_cache is None:
+            self._state_cache = text_frame(
+                json_encoder.encode(
+                    Notification(method="stateChanged", params=self.state)
+                )
+            )
+        return self._state_cache
+
     def get_state_dict(self) -> dict[str, Any]:
         """Get the current state as a dictionary."""
         return {
@@ -190,7 +350,7 @@ class MediaPlayerServer:
         if self.state.state == "paused":
             self.state.state = "playing"
             logger.info("Playback resumed")
-            await self.broadcast_state()
+            self._mark_state_dirty()
         return True
 
     async def handle_pause(self, params: dict[str, Any]) -> bool:
@@ -198,7 +358,7 @@ class MediaPlayerServer:
         if self.state.state == "playing":
             self.state.state = "paused"
             logger.info("Playback paused")
-            await self.broadcast_state()
+            self._mark_state_dirty()
         return True
 
     async def handle_stop(self, params: dict[str, Any]) -> bool:
@@ -206,16 +366,30 @@ class MediaPlayerServer:
         self.state.state = "idle"
         self.state.media = None
         logger.info("Playback stopped")
-        await self.broadcast_state()
+        self._mark_state_dirty()
         return True
 
     async def handle_setVolume(self, params: dict[str, Any]) -> bool:
         """Handle setVolume method."""
-        if "level" in params:
-            level = max(0.0, min(1.0, float(params["level"])))
-            self.state.volume = level
-            logger.info(f"Volume set to {level:.2%}")
-            await self.broadcast_state()
+        level = params.get("level")
+        if level is None:
+            return True
+        if not isinstance(level, float):
+            level = float(level)
+
+        # Clamp to [0, 1] (NaN fails both tests and becomes 1.0)
+        if level < 0.0:
+            level = 0.0
+        elif not level <= 1.0:
+            level = 1.0
+
+        # Sliders often resend the current level; don't broadcast for those
+        if level == self.state.volume:
+            return True
+
+        self.state.volume = level
+        logger.info(f"Volume set to {level:.2%}")
+        self._mark_state_dirty()
         return True
 
     async def handle_load(self, params: dict[str, Any]) -> bool:
@@ -235,5 +409,5 @@ class MediaPlayerServer:
         self.state.state = (
             "playing" if params.get("options", {}).get("autoplay", True) else "paused"
         )
-        await self.broadcast_state()
+        self._mark_state_dirty()
         return True